@@ -1,106 +1,458 @@
 import argparse
 import asyncio
-import hashlib
+import codecs
 import json
+import logging
 import os
+import queue
 import random
-from asyncio import Lock
-from typing import Set
+import sys
+from contextlib import nullcontext
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Set
 
 from datasets import load_dataset
 from tqdm.asyncio import tqdm
 
-import aiofiles
 import aiohttp
+import orjson
 import uvloop
+import xxhash
+
+
+logger = logging.getLogger(__name__)
+
+# The writer appends up to WRITE_BATCH_SIZE results per write, waiting at most WRITE_BATCH_TIMEOUT seconds to fill a
+# batch, and flushes every FLUSH_EVERY_N_BATCHES batches or once written rows are FLUSH_INTERVAL seconds old
+WRITE_BATCH_SIZE = 256
+WRITE_BATCH_TIMEOUT = 0.05
+FLUSH_EVERY_N_BATCHES = 16
+FLUSH_INTERVAL = 5.0
+# Results waiting to be written; producers block once the writer falls this far behind
+WRITE_QUEUE_SIZE = 4 * WRITE_BATCH_SIZE
+# Size of the reservoir used to shuffle the streamed dataset, and number of rows pulled from it per thread hop
+SHUFFLE_BUFFER_SIZE = 10_000
+READ_CHUNK_SIZE = 256
+# Bytes decoded from the start of each output row to read its uuid on resume
+UUID_PREFIX_SIZE = 4096
+# Buffer size for the stdlib file handles used on the resume scan and the output appends
+FILE_BUFFER_SIZE = 1 << 20
+
+
+def setup_logging() -> QueueListener:
+    """Route log records through a queue so that formatting and stdout writes happen off the event loop thread."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    )
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+class Admission:
+    """Caps the number of in-flight examples with a counter guarded by an `asyncio.Condition`."""
+
+    def __init__(self, max_concurrent: int):
+        self._active = 0
+        self._cap = max_concurrent
+        self._cond = asyncio.Condition()
+        # Strong references to the notifier tasks scheduled by `release`, so they are not garbage collected
+        self._notify_tasks: Set[asyncio.Task] = set()
+
+    @property
+    def active(self) -> int:
+        return self._active
 
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self._cap)
+            self._active += 1
 
-file_lock = Lock()
+    def release(self):
+        """Free a slot. Synchronous so that it can be called from a task done-callback."""
+        self._active -= 1
+        task = asyncio.get_running_loop().create_task(self._notify())
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
 
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify(1)
 
-async def generate_completion(session, prompt, args):
+
+# Upper bound in seconds on the delay between two attempts of the same request
+MAX_RETRY_DELAY = 60
+
+
+def _retry_after(response) -> Optional[float]:
+    """Delay in seconds requested by a rate-limited (429) response, if the server provides one."""
+    try:
+        return min(MAX_RETRY_DELAY, max(0.0, float(response.headers["Retry-After"])))
+    except (KeyError, ValueError):
+        return None
+
+
+API_HEADERS = {"Authorization": "Bearer EMPTY"}
+
+
+async def generate_completion(session, limiter, payload, args):
     retry_budget = 10
+    attempt = 0
     while retry_budget > 0:
+        retry_after = None
         try:
-            await asyncio.sleep(random.uniform(0.0, 0.1))
-            async with session.post(
-                f"http://{args.api_addr}/v1/chat/completions",
-                json={
-                    "model": "default",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": args.max_tokens,
-                    "temperature": args.temperature,
-                    "top_p": args.top_p,
-                },
-                headers={"Authorization": "Bearer EMPTY"},
-            ) as response:
-                return await response.json(content_type=None)
+            async with limiter:
+                async with session.post(args.api_url, json=payload, headers=API_HEADERS) as response:
+                    if response.status != 429:
+                        return await response.json(content_type=None)
+                    retry_after = _retry_after(response)
+                    logger.warning(f"API rate limited (will retry): retry-after={retry_after}")
         except Exception as e:
-            print(f"API error (will retry): {e}")
-            retry_budget -= 1
-            await asyncio.sleep(10)
+            logger.warning(f"API error (will retry): {e}")
+        retry_budget -= 1
+        if retry_budget == 0:
+            break
+        # Honour the server's Retry-After when given, otherwise back off exponentially with jitter
+        if retry_after is None:
+            retry_after = min(MAX_RETRY_DELAY, 2**attempt) + random.random() * 0.25
+        attempt += 1
+        await asyncio.sleep(retry_after)
     return None
 
 
-async def process_example(example, session, args, output_file, pbar):
+def _index_file(output_file):
+    """Sidecar file listing the uuid keys of the rows in `output_file`.
+
+    Each line is a JSON array `[offset, key, ...]`, where `offset` is the size of the output once those rows are
+    written.
+    """
+    return f"{output_file}.idx"
+
+
+def _write_batch(f, index_f, results, uuid_column, offset):
+    rows, keys = [], []
+    for result in results:
+        # Serialize rows one by one, so that a row orjson rejects doesn't take the rest of the batch down with it
+        try:
+            rows.append(orjson.dumps(result) + b"\n")
+        except TypeError as e:
+            logger.error(f"Skipping result {result.get(uuid_column)!r} that could not be serialized: {e}")
+            continue
+        keys.append(_uuid_key(result[uuid_column]))
+    if not rows:
+        return offset
+
+    data = b"".join(rows)
+    f.write(data)
+    offset += len(data)
+    index_f.write(orjson.dumps([offset, *keys]) + b"\n")
+    return offset
+
+
+def _flush(f, index_f):
+    f.flush()
+    index_f.flush()
+
+
+async def writer_loop(f, index_f, uuid_column, write_queue):
+    """Drain `write_queue` into the output and index files until a `None` sentinel is received."""
+    loop = asyncio.get_running_loop()
+    unflushed_batches = 0
+    last_flush = loop.time()
+    offset = f.tell()
+    in_flight = None
+
+    async def run_in_thread(func, *args):
+        nonlocal in_flight
+        in_flight = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        # Shielded, so that a cancelled writer can wait for the thread to finish before touching the files again
+        return await asyncio.shield(in_flight)
+
+    try:
+        while True:
+            if unflushed_batches:
+                # Don't let written rows sit in the buffer while the queue is idle
+                try:
+                    timeout = max(0.0, last_flush + FLUSH_INTERVAL - loop.time())
+                    batch = [await asyncio.wait_for(write_queue.get(), timeout)]
+                except asyncio.TimeoutError:
+                    await run_in_thread(_flush, f, index_f)
+                    unflushed_batches = 0
+                    last_flush = loop.time()
+                    continue
+            else:
+                batch = [await write_queue.get()]
+            deadline = loop.time() + WRITE_BATCH_TIMEOUT
+            while batch[-1] is not None and len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(write_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            results = [result for result in batch if result is not None]
+            try:
+                if results:
+                    # Serialize in the worker thread too, so large generations don't block the event loop
+                    offset = await run_in_thread(_write_batch, f, index_f, results, uuid_column, offset)
+                    unflushed_batches += 1
+                    if unflushed_batches >= FLUSH_EVERY_N_BATCHES or loop.time() - last_flush >= FLUSH_INTERVAL:
+                        await run_in_thread(_flush, f, index_f)
+                        unflushed_batches = 0
+                        last_flush = loop.time()
+            except Exception as e:
+                logger.error(f"Error writing {len(results)} results: {e}")
+            finally:
+                for _ in batch:
+                    write_queue.task_done()
+
+            if len(results) < len(batch):
+                break
+    finally:
+        # Also runs when the writer is cancelled (e.g. on Ctrl-C), so buffered rows and index entries are not lost
+        if in_flight is not None and not in_flight.done():
+            await asyncio.wait({in_flight})
+        _flush(f, index_f)
+
+
+async def _abort_if_writer_stops(coro, writer_task):
+    """Run `coro`, aborting if the writer task exits first since the queued results could then never be written."""
+    task = asyncio.ensure_future(coro)
+    await asyncio.wait({task, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+    if task.done():
+        return task.result()
+    task.cancel()
+    writer_task.result()  # Re-raises the writer's error
+    raise RuntimeError("The output writer stopped before all results were written")
+
+
+async def process_example(example, session, limiter, args, write_queue, pbar):
     prompt = args.prompt_template.format(prompt=example[args.prompt_column])
+    # The request body is identical for every generation and retry of this example, so build it once
+    payload = {
+        "model": "default",
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "top_p": args.top_p,
+    }
 
     try:
-        tasks = [generate_completion(session, prompt, args) for _ in range(args.num_generations)]
+        tasks = [generate_completion(session, limiter, payload, args) for _ in range(args.num_generations)]
 
         completions = await asyncio.gather(*tasks)
 
         if any(completion is None for completion in completions):
-            print(f"Error processing example")
+            logger.warning("Error processing example")
             pbar.update(1)
             return None
 
-        generations = []
-        finish_reasons = []
-        api_metadata = []
-
-        for completion in completions:
-            generations.append(completion["choices"][0]["message"]["content"])
-            finish_reasons.append(completion["choices"][0]["finish_reason"])
-            api_metadata.append(completion["usage"])
+        choices = [completion["choices"][0] for completion in completions]
+        generations = [choice["message"]["content"] for choice in choices]
+        finish_reasons = [choice["finish_reason"] for choice in choices]
+        api_metadata = [completion["usage"] for completion in completions]
 
-        # Combine original dataset fields with generations
+        # Combine original dataset fields with generations. The uuid goes first so that resume scans only need to
+        # decode the start of each line
         result = {
+            args.uuid_column: example[args.uuid_column],
             **example,  # Preserve all original dataset fields
             "generations": generations,
             "finish_reasons": finish_reasons,
             "api_metadata": api_metadata,
         }
 
-        # Write to file with lock
-        async with file_lock:
-            async with aiofiles.open(output_file, mode="a") as f:
-                await f.write(json.dumps(result) + "\n")
-                await f.flush()
+        # Hand off to the writer task, which batches appends to the output file
+        await write_queue.put(result)
 
-        pbar.set_postfix(active=len(pbar.active_tasks), refresh=False)
+        pbar.set_postfix(active=pbar.admission.active, refresh=False)
         pbar.update(1)
 
         return result
     except Exception as e:
-        print(f"Error processing example: {e}")
+        logger.warning(f"Error processing example: {e}")
         pbar.update(1)
         return None
 
 
-async def load_processed_uuids(output_file, uuid_column):
+def _uuid_key(value):
+    """Use hashable scalar uuids as-is and only hash the others (e.g. lists or dicts)."""
+    if isinstance(value, (str, int, bytes)):
+        return value
+    return xxhash.xxh3_64_intdigest(str(value))
+
+
+def _scan_output_uuids(output_file, uuid_column, start=0):
     processed_uuids = set()
-    if os.path.exists(output_file):
-        async with aiofiles.open(output_file, mode="r") as f:
-            async for line in f:
-                try:
-                    data = json.loads(line)
-                    processed_uuids.add(hashlib.md5(str(data[uuid_column]).encode()).hexdigest())
-                except json.JSONDecodeError:
+    # Rows are written with the uuid as their first key, e.g. `{"uuid":"..."` (orjson) or `{"uuid": "..."` (json)
+    uuid_prefix = b"{" + orjson.dumps(uuid_column) + b":"
+    uuid_prefix_len = len(uuid_prefix.decode("utf-8"))
+    decoder = json.JSONDecoder()
+    # The output is UTF-8 encoded by orjson, so read bytes rather than relying on the locale's encoding
+    with open(output_file, mode="rb", buffering=FILE_BUFFER_SIZE) as f:
+        f.seek(start)
+        for line in f:
+            try:
+                if not line.endswith(b"}\n"):
+                    # Row cut short by a crash, regenerate it
                     continue
+                if line.startswith(uuid_prefix):
+                    # Only decode the start of the row instead of the full row with its generations. The incremental
+                    # decoder holds back a multi-byte character cut at the end of the prefix
+                    text = codecs.getincrementaldecoder("utf-8")().decode(line[:UUID_PREFIX_SIZE])
+                    idx = uuid_prefix_len
+                    while text[idx : idx + 1] == " ":
+                        idx += 1
+                    try:
+                        uuid, end = decoder.raw_decode(text, idx)
+                        # The value must be followed by a delimiter, or the prefix may have cut it (e.g. digits)
+                        complete = end < len(text)
+                    except json.JSONDecodeError:
+                        complete = False
+                    if not complete:
+                        if len(line) <= UUID_PREFIX_SIZE:
+                            continue
+                        uuid, _ = decoder.raw_decode(line.decode("utf-8"), idx)
+                else:
+                    # Rows written before the uuid was stored as the first key
+                    uuid = orjson.loads(line)[uuid_column]
+                processed_uuids.add(_uuid_key(uuid))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+    return processed_uuids
+
+
+def _terminate_last_line(output_file):
+    """Make sure rows appended to `output_file` start on a new line, even if the last one was cut short by a crash."""
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        return
+    with open(output_file, mode="rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def _read_index(index_file):
+    """Return the uuid keys listed in `index_file` and the size of the output they cover."""
+    processed_uuids = set()
+    covered = 0
+    with open(index_file, mode="rb", buffering=FILE_BUFFER_SIZE) as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # Entry cut short by a crash; entries are in output order, so the ones before it are still valid
+                break
+            if not isinstance(entry, list) or not entry or not isinstance(entry[0], int):
+                break
+            processed_uuids.update(entry[1:])
+            covered = entry[0]
+    return processed_uuids, covered
+
+
+def _scan_uuids(output_file, uuid_column):
+    index_file = _index_file(output_file)
+    if not os.path.exists(output_file):
+        # A leftover index would otherwise mark rows as processed that are not in the (new) output file
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        return set()
+
+    output_size = os.path.getsize(output_file)
+    processed_uuids, covered = set(), 0
+    if os.path.exists(index_file):
+        processed_uuids, covered = _read_index(index_file)
+        if covered > output_size:
+            # The index lists rows that never reached the output (e.g. after a crash), so it cannot be trusted
+            processed_uuids, covered = set(), 0
+
+    # Only scan the rows the index doesn't cover, e.g. from an interrupted run or from before the index existed
+    if covered < output_size:
+        processed_uuids |= _scan_output_uuids(output_file, uuid_column, start=covered)
+
+    # Rewrite the index as a single entry covering the whole output, so the next restart only needs to read the index
+    with open(f"{index_file}.tmp", mode="wb") as f:
+        f.write(orjson.dumps([output_size, *processed_uuids]) + b"\n")
+    os.replace(f"{index_file}.tmp", index_file)
     return processed_uuids
 
 
+async def generate(dataset, processed_uuids, args, write_queue):
+    if args.rps:
+        from aiolimiter import AsyncLimiter
+
+        # The bucket must hold at least one request, so express rates below 1/s as one request per 1/rps seconds
+        if args.rps >= 1:
+            limiter = AsyncLimiter(max_rate=args.rps, time_period=1)
+        else:
+            limiter = AsyncLimiter(max_rate=1, time_period=1 / args.rps)
+    else:
+        limiter = nullcontext()
+    admission = Admission(args.max_concurrent)
+    # Strong references only, so that pending tasks are not garbage collected; admission is gated by `admission`
+    pending_tasks: Set[asyncio.Task] = set()
+
+    num_examples = None
+    if dataset.info.splits is not None and "train" in dataset.info.splits:
+        num_examples = dataset.info.splits["train"].num_examples
+    pbar = tqdm(
+        total=num_examples - len(processed_uuids) if num_examples else None,
+        desc="Generating responses",
+        unit="row",
+        mininterval=2,
+        smoothing=0.0001,
+    )
+    pbar.admission = admission
+
+    # Each in-flight example issues `num_generations` concurrent requests, so size the pool for all of them
+    max_connections = args.max_concurrent * args.num_generations
+    async with aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=60 * 60),
+        connector=aiohttp.TCPConnector(
+            limit=max_connections,
+            limit_per_host=max_connections,
+            ttl_dns_cache=300,
+            keepalive_timeout=60 * 60,
+            force_close=False,
+            enable_cleanup_closed=True,
+        ),
+    ) as session:
+        examples = iter(dataset)
+        while True:
+            # Streaming fetches shards and fills the shuffle buffer while iterating, so do it off the event loop
+            chunk = await asyncio.to_thread(lambda: list(islice(examples, READ_CHUNK_SIZE)))
+            if not chunk:
+                break
+
+            for example in chunk:
+                uuid = _uuid_key(example[args.uuid_column])
+                if uuid in processed_uuids:
+                    continue
+
+                # Wait for a free slot if we've hit the concurrency limit
+                await admission.acquire()
+
+                task = asyncio.create_task(process_example(example, session, limiter, args, write_queue, pbar))
+                pending_tasks.add(task)
+                task.add_done_callback(pending_tasks.discard)
+                task.add_done_callback(lambda t: admission.release())
+
+        # Wait for remaining tasks
+        if pending_tasks:
+            await asyncio.gather(*pending_tasks, return_exceptions=True)
+
+    # Wait until the writer has drained the remaining results
+    await write_queue.join()
+
+    pbar.close()
+
+
 async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset-name", type=str, required=True)
@@ -118,57 +470,45 @@ async def main():
     parser.add_argument("--top-p", type=float, default=0.95)
     parser.add_argument("--max-tokens", type=int, default=16384)
     parser.add_argument("--max-concurrent", type=int, default=1000)
+    parser.add_argument(
+        "--rps", type=float, default=None, help="Maximum API requests per second (default: no rate limit)"
+    )
     args = parser.parse_args()
-
-    dataset = load_dataset(args.dataset_name, split="train").shuffle()
-    processed_uuids = await load_processed_uuids(args.output_file, args.uuid_column)
+    if args.rps is not None and args.rps <= 0:
+        parser.error("--rps must be positive")
+    args.api_url = f"http://{args.api_addr}/v1/chat/completions"
+
+    # Stream the dataset so that (re)starts don't have to materialize and shuffle the whole table first
+    dataset = load_dataset(args.dataset_name, split="train", streaming=True).shuffle(buffer_size=SHUFFLE_BUFFER_SIZE)
+    await asyncio.to_thread(_terminate_last_line, args.output_file)
+    processed_uuids = await asyncio.to_thread(_scan_uuids, args.output_file, args.uuid_column)
     if processed_uuids:
-        print(f"Found {len(processed_uuids)} already processed examples, resuming from there...")
-
-    if not os.path.exists(args.output_file):
-        async with aiofiles.open(args.output_file, mode="w") as f:
-            await f.write("")
-
-    active_tasks: Set[asyncio.Task] = set()
-
-    pbar = tqdm(
-        total=len(dataset) - len(processed_uuids),
-        desc="Generating responses",
-        unit="row",
-        mininterval=2,
-        smoothing=0.0001,
-    )
-    pbar.active_tasks = active_tasks
-
-    async with aiohttp.ClientSession(
-        timeout=aiohttp.ClientTimeout(total=60 * 60),
-        connector=aiohttp.TCPConnector(limit=args.max_concurrent, ttl_dns_cache=300, keepalive_timeout=60 * 60),
-    ) as session:
-        for example in dataset:
-            uuid = hashlib.md5(str(example[args.uuid_column]).encode()).hexdigest()
-            if uuid not in processed_uuids:
-                # Wait if we've hit the concurrency limit
-                while len(active_tasks) >= args.max_concurrent:
-                    done, active_tasks = await asyncio.wait(active_tasks, return_when=asyncio.FIRST_COMPLETED)
-                    for task in done:
-                        try:
-                            await task
-                        except Exception as e:
-                            print(f"Task failed: {e}")
-
-                task = asyncio.create_task(process_example(example, session, args, args.output_file, pbar))
-                active_tasks.add(task)
-                task.add_done_callback(active_tasks.discard)
-
-                pbar.set_postfix(active=len(active_tasks), refresh=True)
-
-        # Wait for remaining tasks
-        if active_tasks:
-            await asyncio.gather(*active_tasks, return_exceptions=True)
+        logger.info(f"Found {len(processed_uuids)} already processed examples, resuming from there...")
+
+    # Open the output before generating anything, so that e.g. a missing directory fails fast
+    with (
+        open(args.output_file, mode="ab", buffering=FILE_BUFFER_SIZE) as f,
+        open(_index_file(args.output_file), mode="ab") as index_f,
+    ):
+        write_queue: asyncio.Queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+        writer_task = asyncio.create_task(writer_loop(f, index_f, args.uuid_column, write_queue))
+        try:
+            await _abort_if_writer_stops(generate(dataset, processed_uuids, args, write_queue), writer_task)
 
-    pbar.close()
+            # Stop the writer once everything has been written
+            await write_queue.put(None)
+            await writer_task
+        finally:
+            # On errors or Ctrl-C, stop the writer while the files are still open so that its final flush succeeds
+            if not writer_task.done():
+                writer_task.cancel()
+            await asyncio.wait({writer_task})
 
 
 if __name__ == "__main__":
+    listener = setup_logging()
     uvloop.install()
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()
@@ -59,6 +59,7 @@ _deps = [
     "lighteval @ git+https://github.com/huggingface/lighteval.git@d3da6b9bbf38104c8b5e1acc86f83541f9a502d1",  # Critical bug fix for tokenizer revisions: https://github.com/huggingface/lighteval/pull/721
     "math-verify==0.5.2",  # Used for math verification in grpo
     "morphcloud==0.1.67",
+    "orjson>=3.9.0",
     "packaging>=23.0",
     "parameterized>=0.9.0",
     "peft>=0.14.0",
@@ -73,7 +74,9 @@ _deps = [
     "wandb>=0.19.1",
     "async-lru>=2.0.5",
     "aiofiles>=24.1.0",
+    "aiolimiter>=1.1.0",
     "pandas>=2.2.3",
+    "xxhash>=3.0.0",
 ]
 
 # this is a lookup table with items like:
@@ -95,7 +98,8 @@ extras["torch"] = deps_list("torch")
 extras["quality"] = deps_list("ruff", "isort", "flake8")
 extras["code"] = deps_list("e2b-code-interpreter", "python-dotenv", "morphcloud", "jieba", "pandas", "aiofiles")
 extras["eval"] = deps_list("lighteval", "math-verify")
-extras["dev"] = extras["quality"] + extras["tests"] + extras["eval"] + extras["code"]
+extras["generate"] = deps_list("orjson", "aiolimiter", "xxhash")
+extras["dev"] = extras["quality"] + extras["tests"] + extras["eval"] + extras["code"] + extras["generate"]
 
 # core dependencies shared across the whole project - keep this to a bare minimum :)
 install_requires = [
@@ -20,6 +20,7 @@ import json
 import math
 import re
 from functools import partial, update_wrapper
+from itertools import islice
 from typing import Callable, Dict, Literal, Optional
 
 from latex2sympy2_extended import NormalizationConfig
@@ -37,15 +38,42 @@ from .utils.competitive_programming import score_submission as cf_score_submissi
 from .utils.competitive_programming import score_subtask
 
 
+FORMAT_PATTERN = re.compile(r"^<think>\n.*?\n</think>\n<answer>\n.*?\n</answer>$", re.DOTALL | re.MULTILINE)
+REASONING_STEPS_PATTERN = re.compile(r"(Step \d+:|^\d+\.|\n-|\n\*|First,|Second,|Next,|Finally,)")
+
+
+_GOLD_PARSE_CACHE_SIZE = 4096
+_gold_parse_cache: dict[tuple[str, bool], list] = {}
+
+
+def _parse_gold_solution(sol: str, latex_only: bool = False):
+    """Parse a ground truth solution, caching the result since GRPO groups share the same solution.
+
+    Empty results are not cached, since `parse` also returns `[]` on a (possibly transient) timeout.
+    """
+    key = (sol, latex_only)
+    gold_parsed = _gold_parse_cache.get(key)
+    if gold_parsed is not None:
+        return gold_parsed
+
+    if latex_only:
+        gold_parsed = parse(sol, extraction_mode="first_match", extraction_config=[LatexExtractionConfig()])
+    else:
+        gold_parsed = parse(sol, extraction_mode="first_match")
+    if len(gold_parsed) != 0:
+        if len(_gold_parse_cache) >= _GOLD_PARSE_CACHE_SIZE:
+            # Evict the oldest entry (dicts keep insertion order)
+            del _gold_parse_cache[next(iter(_gold_parse_cache))]
+        _gold_parse_cache[key] = gold_parsed
+    return gold_parsed
+
+
 def accuracy_reward(completions: list[list[dict[str, str]]], solution: list[str], **kwargs) -> list[Optional[float]]:
     """Reward function that checks if the completion is the same as the ground truth."""
     contents = [completion[0]["content"] for completion in completions]
     rewards = []
     for content, sol in zip(contents, solution):
-        gold_parsed = parse(
-            sol,
-            extraction_mode="first_match",
-        )
+        gold_parsed = _parse_gold_solution(sol)
         if len(gold_parsed) != 0:
             # We require the answer to be provided in correct latex (no malformed operators)
             answer_parsed = parse(
@@ -84,9 +112,8 @@ def accuracy_reward(completions: list[list[dict[str, str]]], solution: list[str]
 
 def format_reward(completions, **kwargs):
     """Reward function that checks if the reasoning process is enclosed within <think> and </think> tags, while the final answer is enclosed within <answer> and </answer> tags."""
-    pattern = r"^<think>\n.*?\n</think>\n<answer>\n.*?\n</answer>$"
     completion_contents = [completion[0]["content"] for completion in completions]
-    matches = [re.match(pattern, content, re.DOTALL | re.MULTILINE) for content in completion_contents]
+    matches = [FORMAT_PATTERN.match(content) for content in completion_contents]
     return [1.0 if match else 0.0 for match in matches]
 
 
@@ -121,9 +148,8 @@ def reasoning_steps_reward(completions, **kwargs):
         \n\* - matches bullet points with asterisks
         First,|Second,|Next,|Finally, - matches transition words
     """
-    pattern = r"(Step \d+:|^\d+\.|\n-|\n\*|First,|Second,|Next,|Finally,)"
     completion_contents = [completion[0]["content"] for completion in completions]
-    matches = [len(re.findall(pattern, content)) for content in completion_contents]
+    matches = [len(REASONING_STEPS_PATTERN.findall(content)) for content in completion_contents]
 
     # Magic number 3 to encourage 3 steps and more, otherwise partial reward
     return [min(1.0, count / 3) for count in matches]
@@ -148,11 +174,7 @@ def len_reward(completions: list[Dict[str, str]], solution: list[str], **kwargs)
     # First check correctness of answers
     correctness = []
     for content, sol in zip(contents, solution):
-        gold_parsed = parse(
-            sol,
-            extraction_mode="first_match",
-            extraction_config=[LatexExtractionConfig()],
-        )
+        gold_parsed = _parse_gold_solution(sol, latex_only=True)
         if len(gold_parsed) == 0:
             # Skip unparseable examples
             correctness.append(True)  # Treat as correct to avoid penalizing
@@ -230,11 +252,7 @@ def get_cosine_scaled_reward(
         rewards = []
 
         for content, sol in zip(contents, solution):
-            gold_parsed = parse(
-                sol,
-                extraction_mode="first_match",
-                extraction_config=[LatexExtractionConfig()],
-            )
+            gold_parsed = _parse_gold_solution(sol, latex_only=True)
             if len(gold_parsed) == 0:
                 rewards.append(1.0)  # Skip unparseable examples
                 print("Failed to parse gold solution: ", sol)
@@ -299,7 +317,7 @@ def get_repetition_penalty_reward(ngram_size: int, max_penalty: float, language:
 
         def zipngram(text: str, ngram_size: int):
             words = text.lower().split()
-            return zip(*[words[i:] for i in range(ngram_size)]), words
+            return zip(*[islice(words, i, None) for i in range(ngram_size)]), words
 
     elif language == "zh":
         from transformers.utils.import_utils import _is_package_available
@@ -311,7 +329,7 @@ def get_repetition_penalty_reward(ngram_size: int, max_penalty: float, language:
             import jieba
 
             seg_list = list(jieba.cut(text))
-            return zip(*[seg_list[i:] for i in range(ngram_size)]), seg_list
+            return zip(*[islice(seg_list, i, None) for i in range(ngram_size)]), seg_list
 
     else:
         raise ValueError(
@@ -334,17 +352,14 @@ def get_repetition_penalty_reward(ngram_size: int, max_penalty: float, language:
                 rewards.append(0.0)
                 continue
 
-            ngrams = set()
-            total = 0
             ngram_array, words = zipngram(completion, ngram_size)
 
             if len(words) < ngram_size:
                 rewards.append(0.0)
                 continue
 
-            for ng in ngram_array:
-                ngrams.add(ng)
-                total += 1
+            ngrams = set(ngram_array)
+            total = len(words) - ngram_size + 1
 
             scaling = 1 - len(ngrams) / total
             reward = scaling * max_penalty